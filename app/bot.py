@@ -1,4 +1,4 @@
-from aiogram import Bot, Dispatcher
+from aiogram import Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command
 from aiogram.types import Message
@@ -19,6 +19,25 @@ bot = Bot(
 )
 dp = Dispatcher()
 
+# Индикатор "печатает" показывается, только если ответ готовится дольше
+# _TYPING_DELAY секунд, и обновляется каждые _TYPING_INTERVAL секунд
+# (Telegram гасит его примерно через 5 секунд)
+_TYPING_DELAY = 0.3
+_TYPING_INTERVAL = 4.5
+
+
+async def _keep_typing(message: Message) -> None:
+    """Показывает индикатор "печатает", пока задачу не отменят."""
+    await asyncio.sleep(_TYPING_DELAY)
+    while True:
+        try:
+            await message.bot.send_chat_action(
+                chat_id=message.chat.id, action="typing"
+            )
+        except Exception as e:
+            logger.warning("Не удалось отправить индикатор: %s", e)
+        await asyncio.sleep(_TYPING_INTERVAL)
+
 
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
@@ -51,40 +70,52 @@ async def cmd_help(message: Message):
     await message.answer(help_text, parse_mode=ParseMode.HTML)
 
 
-@dp.message()
+# Фильтр отсекает сообщения без текста и команды до вызова обработчика
+@dp.message(F.text & ~F.text.startswith('/'))
 async def handle_text_query(message: Message):
     """Основной обработчик текстовых запросов."""
     user_query = message.text.strip()
-
-    # Игнорируем пустые сообщения и команды
+    # Пустые сообщения и команды с пробелами в начале ("  /help")
+    # фильтр пропускает: проверяем уже очищенный текст
     if not user_query or user_query.startswith('/'):
         return
 
-    logger.info(f"Получен запрос от {message.from_user.id}: {user_query}")
+    logger.info("Получен запрос от %s: %s", message.from_user.id, user_query)
 
-    # Отправляем индикатор "печатает"
-    await message.bot.send_chat_action(
-        chat_id=message.chat.id, action="typing"
-    )
+    # Индикатор "печатает" работает в фоне; быстрые ответы (шаблон, кэш)
+    # успевают раньше, и запрос к Telegram не отправляется вовсе
+    typing_task = asyncio.create_task(_keep_typing(message))
+    try:
+        await _answer_query(message, user_query)
+    finally:
+        typing_task.cancel()
 
+
+async def _answer_query(message: Message, user_query: str) -> None:
+    """Генерирует SQL, выполняет его и отправляет числовой ответ."""
     max_retries = 2
     for attempt in range(max_retries):
         try:
             # 1. Преобразуем текст в SQL
             sql_query = await query_processor.text_to_sql(user_query)
 
-            logger.info(f"Сгенерирован SQL (попытка {attempt + 1}): {sql_query}")
+            logger.info(
+                "Сгенерирован SQL (попытка %s): %s", attempt + 1, sql_query
+            )
 
             # 2. Выполняем SQL запрос
             result = await db.execute_query(sql_query)
 
             # 3. Отправляем результат (ВАЖНО: ТОЛЬКО число без пояснений!)
             await message.answer(str(result))
-            logger.info(f"Успешный ответ: {result}")
+            logger.info("Успешный ответ: %s", result)
             return
 
         except Exception as e:
-            logger.error(f"Ошибка обработки (попытка {attempt + 1}): {e}")
+            logger.error("Ошибка обработки (попытка %s): %s", attempt + 1, e)
+
+            # Не даем кэшу вернуть тот же неудачный SQL на следующей попытке
+            query_processor.forget(user_query)
 
             if attempt < max_retries - 1:
                 # Ждем перед повторной попыткой
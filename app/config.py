@@ -10,6 +10,32 @@ DATABASE_URL = os.getenv(
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 
+# Режим webhook: если задан публичный адрес, Telegram присылает обновления
+# сам, иначе бот работает через long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
 # OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 
-LLM_MODEL = os.getenv("LLM_MODEL", "qwen2.5:0.5b")
+LLM_MODEL = os.getenv("LLM_MODEL", "qwen2.5-coder:1.5b-instruct-q4_K_M")
+
+# Размер контекста модели: системный промпт + вопрос + ответ. Меньший
+# контекст, чем у модели по умолчанию, экономит память под KV-кэш.
+LLM_NUM_CTX = int(os.getenv("LLM_NUM_CTX", "4096"))
+
+# Число потоков генерации (физические ядра CPU); пусто — решает Ollama
+LLM_NUM_THREAD = os.getenv("LLM_NUM_THREAD")
+
+# Сколько модель остается загруженной в Ollama после запроса (сохраняет
+# KV-кэш системного промпта между запросами)
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "30m")
+
+# Таймаут запроса к Ollama (секунды)
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+
+# Размер кэша "вопрос -> SQL" и время жизни кэша результатов (секунды)
+SQL_CACHE_SIZE = int(os.getenv("SQL_CACHE_SIZE", "1024"))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "60"))
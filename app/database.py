@@ -1,14 +1,144 @@
+import re
+import time
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
 import asyncpg
-from app.config import DATABASE_URL
+from app.config import DATABASE_URL, RESULT_CACHE_TTL, SQL_CACHE_SIZE
+
+# Литералы в SQL от модели. Первые три альтернативы оставляют текст как
+# есть: типизированные литералы (INTERVAL '1 day'), позиции в ORDER/GROUP BY
+# и идентификаторы в двойных кавычках нельзя заменить параметром.
+# Остальные строки в одинарных кавычках и целые числа выносятся в $N.
+_LITERAL_RE = re.compile(
+    r"\b(?:interval|date|time|timestamp|timestamptz)\s*'(?:[^']|'')*'"
+    r"|\b(?:order|group)\s+by\s+\d+(?:\s*,\s*\d+)*\b"
+    r'|"(?:[^"]|"")*"'
+    r"|'((?:[^']|'')*)'"
+    r"|(?<![\w.$])(\d+)(?![\w.])",
+    re.IGNORECASE
+)
+
+
+def _parameterize(sql_query: str):
+    """
+    Заменяет литералы в запросе на параметры $1, $2, ...
+
+    Возвращает шаблон запроса и список значений литералов в виде строк.
+    Запросы одинаковой формы дают один шаблон, и asyncpg переиспользует
+    для них подготовленный на сервере план.
+    """
+    args = []
+
+    def replace(match):
+        string_value, number_value = match.group(1, 2)
+        if string_value is not None:
+            args.append(string_value.replace("''", "'"))
+        elif number_value is not None:
+            args.append(number_value)
+        else:
+            return match.group(0)
+        return f"${len(args)}"
+
+    return _LITERAL_RE.sub(replace, sql_query), args
+
+
+def _parse_timestamp(value: str) -> datetime:
+    """Разбирает строку ISO 8601; время без часового пояса считается UTC."""
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+
+def _bounded_int(bits: int):
+    """
+    Возвращает преобразование в целое, которое помещается в тип из bits бит.
+
+    Тип параметра PostgreSQL берет у столбца: в views_count > $1 параметр
+    будет int4, хотя сам литерал 3000000000 читается как int8. Выход за
+    диапазон дает ValueError, и запрос выполняется в исходном виде.
+    """
+    limit = 1 << (bits - 1)
+
+    def convert(value: str) -> int:
+        number = int(value)
+        if not -limit <= number < limit:
+            raise ValueError(f"{value} не помещается в {bits} бит")
+        return number
+
+    return convert
+
+
+# Преобразование текста литерала к типу параметра, выведенному PostgreSQL
+_ARG_CONVERTERS = {
+    'text': str,
+    'varchar': str,
+    'bpchar': str,
+    'name': str,
+    'uuid': str,
+    'int2': _bounded_int(16),
+    'int4': _bounded_int(32),
+    'int8': _bounded_int(64),
+    'numeric': Decimal,
+    'float4': float,
+    'float8': float,
+    'date': date.fromisoformat,
+    'timestamp': lambda value: _parse_timestamp(value).replace(tzinfo=None),
+    'timestamptz': _parse_timestamp,
+}
+
+
+def _decode_numeric(value: str):
+    """
+    Декодирует NUMERIC в int или float вместо медленного Decimal.
+
+    SUM по целым столбцам возвращает NUMERIC без дробной части, AVG — с ней.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+async def _init_connection(connection) -> None:
+    """Настраивает каждое новое соединение пула."""
+    await connection.set_type_codec(
+        'numeric',
+        encoder=str,
+        decoder=_decode_numeric,
+        schema='pg_catalog',
+        format='text'
+    )
 
 
 class Database:
     def __init__(self):
         self.pool = None
+        # Кэш результатов: SQL -> (момент устаревания, результат)
+        self._result_cache = {}
+        # Шаблон запроса -> типы его параметров (None, если шаблон
+        # не удалось подготовить и запрос выполняется как есть)
+        self._param_types = {}
 
     async def connect(self):
-        """Создает пул подключений к БД."""
-        self.pool = await asyncpg.create_pool(DATABASE_URL)
+        """
+        Создает пул подключений к БД.
+
+        create_pool сразу открывает min_size соединений, поэтому первый
+        запрос пользователя не тратит время на установку соединения.
+        """
+        self.pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=4,
+            max_size=16,
+            max_inactive_connection_lifetime=600,
+            command_timeout=10,
+            statement_cache_size=1024,
+            init=_init_connection
+        )
 
     async def disconnect(self):
         """Закрывает пул подключений."""
@@ -20,18 +150,41 @@ class Database:
         Выполняет SQL-запрос и возвращает результат как строку.
         Ожидается, что запрос возвращает одно значение.
         """
-        if not self.pool:
-            await self.connect()
+        cached = self._result_cache.get(sql_query)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+
+        result = await self._fetch_result(sql_query)
+        self._store_result(sql_query, result)
+        return result
 
+    def _store_result(self, sql_query: str, result: str) -> None:
+        """Сохраняет результат в кэш на RESULT_CACHE_TTL секунд."""
+        now = time.monotonic()
+        if len(self._result_cache) >= SQL_CACHE_SIZE:
+            # Сначала выбрасываем устаревшие записи, затем самые старые
+            self._result_cache = {
+                sql: entry for sql, entry in self._result_cache.items()
+                if entry[0] > now
+            }
+            while len(self._result_cache) >= SQL_CACHE_SIZE:
+                del self._result_cache[next(iter(self._result_cache))]
+        self._result_cache[sql_query] = (now + RESULT_CACHE_TTL, result)
+
+    async def _fetch_result(self, sql_query: str) -> str:
+        """Выполняет запрос в БД и приводит результат к строке."""
         async with self.pool.acquire() as connection:
             try:
                 # Выполняем запрос
-                result = await connection.fetchval(sql_query)
+                result = await self._fetchval(connection, sql_query)
 
                 # Преобразуем результат в строку
                 if result is None:
                     return "0"
 
+                if isinstance(result, int):
+                    return format(result, 'd')
+
                 # Для числовых результатов с плавающей точкой
                 if isinstance(result, float):
                     # Округляем до 2 знаков после запятой
@@ -42,6 +195,63 @@ class Database:
             except Exception as e:
                 raise Exception(f"Ошибка выполнения SQL: {e}")
 
+    async def _fetchval(self, connection, sql_query: str):
+        """
+        Выполняет запрос как параметризованный шаблон.
+
+        Если шаблон нельзя подготовить или литерал не приводится к типу
+        параметра, запрос выполняется в исходном виде.
+        """
+        # Запрос уже содержит параметры — нумерацию $N не трогаем
+        if '$' in sql_query:
+            return await connection.fetchval(sql_query)
+
+        template, args = _parameterize(sql_query)
+        if not args:
+            return await connection.fetchval(sql_query)
+
+        # Новый шаблон готовится один раз: выражение из prepare сразу же
+        # используется для выполнения, а не готовится заново в fetchval
+        statement = None
+        if template in self._param_types:
+            param_types = self._param_types[template]
+        else:
+            try:
+                statement = await connection.prepare(template)
+            except asyncpg.PostgresError:
+                param_types = None
+            else:
+                param_types = tuple(
+                    param.name for param in statement.get_parameters()
+                )
+            self._store_param_types(template, param_types)
+
+        if param_types is None:
+            return await connection.fetchval(sql_query)
+
+        try:
+            values = [
+                _ARG_CONVERTERS[param_type](arg)
+                for param_type, arg in zip(param_types, args)
+            ]
+        except (KeyError, ValueError, ArithmeticError):
+            return await connection.fetchval(sql_query)
+
+        if statement is not None:
+            return await statement.fetchval(*values)
+
+        # asyncpg кэширует подготовленные выражения на каждом соединении
+        # (statement_cache_size), поэтому повторный шаблон не планируется
+        return await connection.fetchval(template, *values)
+
+    def _store_param_types(self, template: str, param_types) -> None:
+        """Запоминает типы параметров шаблона; хранит до SQL_CACHE_SIZE."""
+        if (template not in self._param_types
+                and len(self._param_types) >= SQL_CACHE_SIZE):
+            # Выбрасываем самый старый шаблон
+            del self._param_types[next(iter(self._param_types))]
+        self._param_types[template] = param_types
+
 
 # Глобальный экземпляр БД
 db = Database()
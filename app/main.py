@@ -6,9 +6,23 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import asyncio
 import logging
 
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+try:
+    # uvloop (libuv) быстрее стандартного цикла событий; под Windows
+    # он недоступен, и бот работает на стандартном asyncio
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Импортируем dp и уже созданный объект bot из app.bot
 from app.bot import dp, bot
+from app.config import (
+    WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_URL
+)
 from app.database import db
+from app.query_processor import query_processor
 
 # Настройка логирования
 logging.basicConfig(
@@ -26,12 +40,29 @@ async def on_startup():
     await db.connect()
     logger.info("Подключение к БД установлено")
 
+    # Загружаем модель и кэшируем префикс системного промпта
+    await query_processor.warmup()
+
     # Устанавливаем команды бота (используем импортированный bot)
     await bot.set_my_commands([
         {"command": "start", "description": "Запустить бота"},
         {"command": "help", "description": "Помощь по использованию"}
     ])
 
+    if WEBHOOK_URL:
+        # max_connections позволяет Telegram доставлять обновления
+        # параллельно в несколько соединений
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            drop_pending_updates=True,
+            max_connections=40,
+            secret_token=WEBHOOK_SECRET or None
+        )
+        logger.info("Webhook установлен")
+    else:
+        # getUpdates не работает, пока у бота установлен webhook
+        await bot.delete_webhook()
+
     logger.info("Бот успешно запущен!")
 
 
@@ -44,6 +75,24 @@ async def on_shutdown():
     logger.info("Соединение с БД закрыто")
 
 
+async def run_webhook():
+    """Принимает обновления от Telegram через webhook на aiohttp."""
+    app = web.Application()
+    # Каждое обновление обрабатывается в отдельной задаче asyncio
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+        logger.info("Webhook-сервер слушает %s:%s", WEBAPP_HOST, WEBAPP_PORT)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 async def main():
     """Основная функция запуска бота."""
     try:
@@ -51,14 +100,19 @@ async def main():
         await on_startup()
 
         # Запускаем бота (используем импортированные dp и bot)
-        await dp.start_polling(bot)
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
 
     except Exception as e:
-        logger.error(f"Критическая ошибка: {e}")
+        logger.error("Критическая ошибка: %s", e)
 
     finally:
         # Выполняем действия при остановке
         await on_shutdown()
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())
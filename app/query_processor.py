@@ -1,18 +1,55 @@
+import asyncio
+import httpx
 import ollama
 import logging
 import re
-from app.config import LLM_MODEL
+import sqlglot
+from collections import OrderedDict
+from typing import Optional
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from app.config import (
+    LLM_MODEL, LLM_KEEP_ALIVE, LLM_NUM_CTX, LLM_NUM_THREAD, LLM_TIMEOUT,
+    SQL_CACHE_SIZE
+)
 
 logger = logging.getLogger(__name__)
 
-
-class QueryProcessor:
-    def __init__(self):
-        self.system_prompt = self._create_system_prompt()
-
-    def _create_system_prompt(self):
-        """Создает системный промпт с описанием схемы БД."""
-        return """
+# Асинхронный клиент Ollama: генерация не блокирует цикл событий бота.
+# Таймаут не дает зависшему соединению держать обработчик бесконечно,
+# а keep-alive соединения переиспользуются между запросами.
+_client = ollama.AsyncClient(
+    timeout=httpx.Timeout(LLM_TIMEOUT, connect=3.0),
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+)
+
+# Общие параметры генерации. Они должны совпадать между прогревом и
+# рабочими запросами, иначе Ollama перезагрузит модель и сбросит KV-кэш.
+# SQL-запрос укладывается в ~80 токенов, а генерация останавливается на
+# первой точке с запятой (сам стоп-символ Ollama в ответ не включает).
+_LLM_OPTIONS = {
+    'temperature': 0.0,
+    'num_predict': 96,
+    'stop': [';'],
+    'num_ctx': LLM_NUM_CTX,
+}
+if LLM_NUM_THREAD:
+    _LLM_OPTIONS['num_thread'] = int(LLM_NUM_THREAD)
+
+# Префиксы, которые модель иногда ставит перед запросом, и ключевые слова,
+# с которых начинается SQL (в нижнем регистре)
+_ANSWER_PREFIXES = ('sql:', 'query:', 'запрос:', 'ответ:', 'answer:')
+_SQL_KEYWORDS = ('select', 'insert', 'update', 'delete', 'with')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Порядок сообщений для модели: статичная схема -> динамические факты ->
+# вопрос пользователя. Движки инференса (Ollama/llama.cpp, RadixCache-
+# подобные кэши) переиспользуют KV-кэш только для совпадающего префикса,
+# поэтому любые данные, зависящие от запроса (дата, подсказки, списки
+# креаторов), добавляются в _DYNAMIC_CONTEXT, а не в _STATIC_SCHEMA_PROMPT.
+
+# Системный промпт с правилами, описанием схемы БД и примерами
+_STATIC_SCHEMA_PROMPT = """
 Ты — эксперт по SQL и базе данных статистики видео. Твоя задача — преобразовывать вопросы на русском языке в точные SQL-запросы к PostgreSQL.
 
 ПОЛНАЯ СХЕМА БАЗЫ ДАННЫХ:
@@ -86,64 +123,337 @@ class QueryProcessor:
 ВОЗВРАЩАЙ ТОЛЬКО SQL-ЗАПРОС. НИКАКИХ ПОЯСНЕНИЙ.
 """
 
-    async def text_to_sql(self, user_query: str) -> str:
-        """Преобразует текстовый запрос в SQL, используя Ollama."""
-        try:
-            logger.info(f"Преобразую запрос в SQL: {user_query}")
+# Динамический контекст; передается вторым системным сообщением,
+# только если не пуст
+_DYNAMIC_CONTEXT = ""
+
+# Сообщение для повторной попытки, если модель вернула неподходящий SQL
+_CORRECTION_PROMPT = (
+    "Этот ответ не подходит. Нужен ровно один SELECT-запрос, который "
+    "возвращает одно число через агрегатную функцию (COUNT, SUM, AVG, MIN, "
+    "MAX). Верни только исправленный SQL-запрос."
+)
+
+# Шаблоны частых вопросов, для которых SQL строится без обращения к модели.
+# Сопоставляются с вопросом целиком без учета регистра; литералы подставляются
+# в SQL, а слой БД затем выносит их в параметры подготовленного запроса.
+_MONTHS = {
+    'января': 1, 'февраля': 2, 'марта': 3, 'апреля': 4, 'мая': 5,
+    'июня': 6, 'июля': 7, 'августа': 8, 'сентября': 9, 'октября': 10,
+    'ноября': 11, 'декабря': 12,
+}
+_MONTH_PATTERN = '|'.join(_MONTHS)
+_FAST_PATH_TEMPLATES = [
+    (
+        re.compile(
+            r'сколько (?:всего )?видео(?: есть)?(?: в системе)?', re.IGNORECASE
+        ),
+        "SELECT COUNT(*) FROM videos;"
+    ),
+    (
+        re.compile(
+            r'сколько (?:всего )?видео (?:есть )?у креатора '
+            r'(?:с )?id (?P<creator_id>[\w-]+)',
+            re.IGNORECASE
+        ),
+        "SELECT COUNT(*) FROM videos WHERE creator_id = '{creator_id}';"
+    ),
+    (
+        re.compile(
+            r'сколько (?:всего )?видео набрал[оиа]? (?:больше|более) '
+            r'(?P<views>\d+) просмотров',
+            re.IGNORECASE
+        ),
+        "SELECT COUNT(*) FROM videos WHERE views_count > {views};"
+    ),
+    (
+        re.compile(
+            r'на сколько просмотров (?:в сумме |суммарно )?выросли '
+            r'(?:все )?видео (?P<day>\d{1,2}) '
+            rf'(?P<month>{_MONTH_PATTERN}) (?P<year>\d{{4}})(?: года)?',
+            re.IGNORECASE
+        ),
+        "SELECT COALESCE(SUM(delta_views_count), 0) FROM video_snapshots "
+        "WHERE DATE(created_at) = '{year}-{month:02d}-{day:02d}';"
+    ),
+]
+
+
+def _match_fast_path(user_query: str) -> Optional[str]:
+    """Возвращает SQL для вопроса, совпавшего с шаблоном, иначе None."""
+    # Регистр не приводим: он важен для id креатора
+    question = _WHITESPACE_RE.sub(' ', user_query.strip()).rstrip('?!. ')
+    for pattern, template in _FAST_PATH_TEMPLATES:
+        match = pattern.fullmatch(question)
+        if match is None:
+            continue
+        params = match.groupdict()
+        if 'month' in params:
+            params.update(
+                day=int(params['day']),
+                month=_MONTHS[params['month'].lower()],
+                year=int(params['year'])
+            )
+        return template.format(**params)
+    return None
+
+
+def normalize_query(user_query: str) -> str:
+    """
+    Приводит вопрос к виду, используемому как ключ кэша.
+
+    Схлопываются только пробелы: регистр не приводим, так как он важен
+    для id креатора, и вопросы о разных креаторах не должны делить SQL.
+    """
+    return _WHITESPACE_RE.sub(' ', user_query.strip())
 
-            messages = [
-                {"role": "system", "content": self.system_prompt},
-                {"role": "user", "content": user_query}
-            ]
 
-            # Для mistral:7b используем более низкую temperature для точности
-            response = ollama.chat(
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+
+def _find_keyword(text: str, keyword: str) -> int:
+    """Ищет ключевое слово целиком, а не как часть другого слова."""
+    start = text.find(keyword)
+    while start != -1:
+        end = start + len(keyword)
+        if ((start == 0 or not _is_word_char(text[start - 1]))
+                and (end == len(text) or not _is_word_char(text[end]))):
+            return start
+        start = text.find(keyword, start + 1)
+    return -1
+
+
+def is_valid_sql(sql_query: str) -> bool:
+    """
+    Проверяет SQL на стороне клиента, до отправки в PostgreSQL.
+
+    Запрос должен быть ровно одним SELECT с единственным выражением,
+    содержащим агрегатную функцию, без GROUP BY и оконных функций —
+    только такой запрос гарантированно вернет одну строку с одним числом.
+    """
+    try:
+        statements = [
+            statement
+            for statement in sqlglot.parse(sql_query, read='postgres')
+            if statement is not None
+        ]
+    except SqlglotError:
+        return False
+
+    if len(statements) != 1 or not isinstance(statements[0], exp.Select):
+        return False
+
+    # GROUP BY и агрегаты с OVER возвращают по строке на группу или строку
+    # таблицы, а fetchval молча взял бы только первую из них
+    if statements[0].args.get('group') is not None:
+        return False
+
+    projections = statements[0].expressions
+    return (
+        len(projections) == 1
+        and projections[0].find(exp.AggFunc) is not None
+        and projections[0].find(exp.Window) is None
+    )
+
+
+class QueryProcessor:
+    def __init__(self):
+        self.system_prompt = _STATIC_SCHEMA_PROMPT
+        # LRU-кэш: нормализованный вопрос -> сгенерированный SQL
+        self._sql_cache = OrderedDict()
+        # Запросы к модели в процессе: нормализованный вопрос -> Future
+        self._inflight = {}
+
+    async def warmup(self) -> None:
+        """
+        Прогревает модель системным промптом.
+
+        Ollama переиспользует KV-кэш для совпадающего префикса сообщений,
+        пока модель загружена (keep_alive), поэтому после прогрева на каждом
+        запросе заново обрабатывается только вопрос пользователя.
+        """
+        try:
+            await _client.chat(
                 model=LLM_MODEL,
-                messages=messages,
-                options={'temperature': 0.0, 'num_predict': 512}
+                messages=[{"role": "system", "content": self.system_prompt}],
+                options={**_LLM_OPTIONS, 'num_predict': 1},
+                keep_alive=LLM_KEEP_ALIVE
             )
+            logger.info("Модель прогрета системным промптом")
+        except Exception as e:
+            logger.warning("Не удалось прогреть модель: %s", e)
 
-            raw_sql = response['message']['content'].strip()
-            logger.info(f"Получен сырой ответ: {raw_sql}")
-
-            sql_query = self._clean_sql_response(raw_sql)
-            logger.info(f"Очищенный SQL: {sql_query}")
+    async def text_to_sql(self, user_query: str) -> str:
+        """
+        Преобразует текстовый запрос в SQL.
+
+        Частые вопросы разбираются по шаблонам, повторные отдаются из
+        кэша — в обоих случаях без обращения к модели, а
+        одинаковые вопросы, пришедшие одновременно, ждут один общий ответ.
+        """
+        sql_query = _match_fast_path(user_query)
+        if sql_query is not None:
+            logger.info("SQL построен по шаблону: %s", sql_query)
+            return sql_query
 
+        key = normalize_query(user_query)
+        sql_query = self._sql_cache.get(key)
+        if sql_query is not None:
+            self._sql_cache.move_to_end(key)
+            logger.info("SQL взят из кэша: %s", sql_query)
             return sql_query
 
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            # shield: отмена ожидающего обработчика не отменяет общий Future
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            sql_query = await self._generate_sql(user_query)
+        except asyncio.CancelledError:
+            # Ожидающие получают ошибку, а не выдуманный ответ, и проходят
+            # обычный путь повторов обработчика
+            future.set_exception(RuntimeError("Генерация SQL прервана"))
+            # Без ожидающих Future не пишет необработанную ошибку в лог
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+        # Запасной ответ не кэшируем, чтобы следующая попытка снова
+        # обратилась к модели
+        if sql_query != "SELECT 0":
+            self._sql_cache[key] = sql_query
+            if len(self._sql_cache) > SQL_CACHE_SIZE:
+                self._sql_cache.popitem(last=False)
+        future.set_result(sql_query)
+
+        return sql_query
+
+    def forget(self, user_query: str) -> None:
+        """Удаляет вопрос из кэша (например, если SQL не выполнился)."""
+        self._sql_cache.pop(normalize_query(user_query), None)
+
+    async def _generate_sql(self, user_query: str) -> str:
+        """Генерирует SQL по вопросу пользователя, используя Ollama."""
+        try:
+            logger.info("Преобразую запрос в SQL: %s", user_query)
+
+            messages = self._build_messages(user_query)
+
+            raw_sql, sql_query = await self._ask_model(messages)
+            if is_valid_sql(sql_query):
+                return sql_query
+
+            # Одна повторная попытка с указанием на ошибку
+            logger.warning("SQL не прошел проверку: %s", sql_query)
+            messages += [
+                {"role": "assistant", "content": raw_sql},
+                {"role": "user", "content": _CORRECTION_PROMPT}
+            ]
+            _, sql_query = await self._ask_model(messages)
+            if is_valid_sql(sql_query):
+                return sql_query
+
+            logger.warning("SQL снова не прошел проверку: %s", sql_query)
+            return "SELECT 0"
+
         except Exception as e:
-            logger.error(f"Ошибка при работе с Ollama: {e}")
+            logger.error("Ошибка при работе с Ollama: %s", e)
             return "SELECT 0"
 
+    def _build_messages(self, user_query: str):
+        """
+        Собирает сообщения для модели.
+
+        Статичный системный промпт идет первым, чтобы префикс совпадал
+        между запросами и попадал в KV-кэш модели.
+        """
+        messages = [{"role": "system", "content": self.system_prompt}]
+        if _DYNAMIC_CONTEXT:
+            messages.append({"role": "system", "content": _DYNAMIC_CONTEXT})
+        messages.append({"role": "user", "content": user_query})
+        return messages
+
+    async def _ask_model(self, messages):
+        """Запрашивает модель и возвращает сырой ответ и очищенный SQL."""
+        # Нулевая temperature для детерминированного SQL
+        response = await _client.chat(
+            model=LLM_MODEL,
+            messages=messages,
+            options=_LLM_OPTIONS,
+            keep_alive=LLM_KEEP_ALIVE
+        )
+
+        raw_sql = response['message']['content'].strip()
+        logger.info("Получен сырой ответ: %s", raw_sql)
+
+        sql_query = self._clean_sql_response(raw_sql)
+        logger.info("Очищенный SQL: %s", sql_query)
+
+        return raw_sql, sql_query
+
     def _clean_sql_response(self, raw_response: str) -> str:
-        """Очищает ответ модели, оставляя только SQL."""
+        """
+        Очищает ответ модели, оставляя только SQL.
+
+        Разбор идет одним проходом по строке через str.find вместо
+        нескольких регулярных выражений.
+        """
         if not raw_response:
             return "SELECT 0"
 
-        # Удаляем блоки кода с обратными кавычками
-        code_block_pattern = r'```(?:\w+)?\s*(.*?)\s*```'
-        match = re.search(code_block_pattern, raw_response, re.DOTALL | re.IGNORECASE)
-        if match:
-            cleaned = match.group(1).strip()
-        else:
-            cleaned = raw_response
+        cleaned = raw_response
+
+        # Вырезаем содержимое блока кода с обратными кавычками. Закрывающих
+        # кавычек может не быть: генерация обрывается на стоп-символе.
+        fence = cleaned.find('```')
+        if fence != -1:
+            body_start = fence + 3
+            # Пропускаем метку языка (```sql), если за ней перевод строки
+            tag_end = body_start
+            while tag_end < len(cleaned) and _is_word_char(cleaned[tag_end]):
+                tag_end += 1
+            if tag_end == len(cleaned) or cleaned[tag_end] in '\r\n':
+                body_start = tag_end
+            body_end = cleaned.find('```', body_start)
+            if body_end == -1:
+                body_end = len(cleaned)
+            cleaned = cleaned[body_start:body_end].strip()
+
+        low = cleaned.lower()
 
         # Удаляем префиксы типа 'SQL:', 'Query:', 'Запрос:'
-        cleaned = re.sub(r'^(SQL|Query|Запрос|Ответ|Answer):\s*', '', cleaned, flags=re.IGNORECASE)
+        for prefix in _ANSWER_PREFIXES:
+            if low.startswith(prefix):
+                cleaned = cleaned[len(prefix):].lstrip()
+                low = cleaned.lower()
+                break
 
         # Находим начало первого SQL-запроса
-        sql_start_pattern = r'\b(SELECT|INSERT|UPDATE|DELETE|WITH)\b'
-        match = re.search(sql_start_pattern, cleaned, re.IGNORECASE)
-        if match:
-            cleaned = cleaned[match.start():]
+        starts = [
+            position for position in (
+                _find_keyword(low, keyword) for keyword in _SQL_KEYWORDS
+            )
+            if position != -1
+        ]
+        start = min(starts) if starts else 0
 
         # Обрезаем после точки с запятой
-        semicolon_index = cleaned.find(';')
-        if semicolon_index != -1:
-            cleaned = cleaned[:semicolon_index + 1]
+        end = cleaned.find(';', start)
+        end = len(cleaned) if end == -1 else end + 1
+
+        cleaned = cleaned[start:end].strip()
+        if not cleaned:
+            return "SELECT 0"
 
-        cleaned = cleaned.strip()
-        return cleaned if cleaned else "SELECT 0"
+        # Генерация обрывается на стоп-символе, возвращаем точку с запятой
+        if not cleaned.endswith(';'):
+            cleaned += ';'
+        return cleaned
 
 
 # Глобальный экземпляр процессора
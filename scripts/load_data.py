@@ -2,10 +2,13 @@
 Скрипт для загрузки данных из JSON-файла в базу данных PostgreSQL.
 """
 import sys
-import json
 import logging
-from datetime import datetime, timezone
-from typing import Dict, List, Optional
+import threading
+import uuid
+import concurrent.futures
+from itertools import islice
+from operator import itemgetter
+from typing import Dict, List
 from pathlib import Path
 
 # Добавляем корневую директорию проекта в путь Python
@@ -15,172 +18,360 @@ sys.path.insert(0, str(project_root))
 import asyncpg
 import asyncio
 
+try:
+    # ijson читает файл потоково: в памяти одновременно только один пакет
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    # uvloop (libuv) быстрее стандартного цикла событий; под Windows
+    # он недоступен, и загрузка работает на стандартном asyncio
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    # orjson разбирает JSON из bytes на C в несколько раз быстрее json
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Сколько разобранных пакетов может ждать записи в БД
+QUEUE_SIZE = 4
+# Размер блока чтения файла: меньше системных вызовов read, чем
+# при стандартных 8 КиБ буфера open() и 64 КиБ блока ijson
+READ_BUFFER_SIZE = 1 << 20
+# Ожидаемое число снапшотов на видео для начального размера буфера
+# (в videos.json в среднем около 100)
+SNAPSHOTS_PER_VIDEO = 100
+# Как часто (секунды) поток разбора проверяет сигнал остановки, пока ждет
+# места в очереди
+STOP_POLL_INTERVAL = 0.1
+# Прогресс пишется в лог раз в столько пакетов
+LOG_EVERY_BATCHES = 10
+
+VIDEO_COLUMNS = [
+    'id', 'creator_id', 'video_created_at', 'views_count',
+    'likes_count', 'comments_count', 'reports_count',
+    'created_at', 'updated_at'
+]
+SNAPSHOT_COLUMNS = [
+    'id', 'video_id', 'views_count', 'likes_count',
+    'comments_count', 'reports_count',
+    'delta_views_count', 'delta_likes_count',
+    'delta_comments_count', 'delta_reports_count',
+    'created_at', 'updated_at'
+]
+
+# Строка для COPY собирается из словаря одним вызовом на C, без записи
+# в словарь и без отдельного обращения к каждому полю из Python
+_video_row = itemgetter(*VIDEO_COLUMNS)
+_snapshot_row = itemgetter(*SNAPSHOT_COLUMNS)
+
+# Промежуточные таблицы для первичной загрузки. UNLOGGED-таблицы не пишут
+# WAL, а идентификаторы uuid и даты хранятся исходными строками: их
+# разбирает сам PostgreSQL при переносе в основные таблицы. Имена таблиц
+# уникальны для каждой загрузки ({videos_stage}, {snapshots_stage}), чтобы
+# не задеть чужие таблицы и параллельные загрузки
+STAGE_VIDEOS_PREFIX = 'videos_stage_'
+STAGE_SNAPSHOTS_PREFIX = 'video_snapshots_stage_'
+
+CREATE_STAGE_SQL = """
+    CREATE UNLOGGED TABLE {videos_stage} (
+        id text, creator_id varchar(255), video_created_at text,
+        views_count integer, likes_count integer, comments_count integer,
+        reports_count integer, created_at text, updated_at text
+    );
+    CREATE UNLOGGED TABLE {snapshots_stage} (
+        id varchar(255), video_id text, views_count integer,
+        likes_count integer, comments_count integer, reports_count integer,
+        delta_views_count integer, delta_likes_count integer,
+        delta_comments_count integer, delta_reports_count integer,
+        created_at text, updated_at text
+    );
+"""
+DROP_STAGE_SQL = "DROP TABLE IF EXISTS {videos_stage}, {snapshots_stage}"
+
+# Перенос из промежуточных таблиц: один upsert на весь файл. Один upsert
+# не может обновить строку дважды, поэтому из повторов id в файле
+# остается одна, самая свежая по updated_at, версия
+MERGE_VIDEOS_SQL = f"""
+    INSERT INTO videos ({', '.join(VIDEO_COLUMNS)})
+    SELECT DISTINCT ON (id::uuid)
+           id::uuid, creator_id, video_created_at::timestamptz, views_count,
+           likes_count, comments_count, reports_count,
+           created_at::timestamptz, updated_at::timestamptz
+    FROM {{videos_stage}}
+    ORDER BY id::uuid, updated_at::timestamptz DESC
+    ON CONFLICT (id) DO UPDATE SET
+        views_count = EXCLUDED.views_count,
+        updated_at = EXCLUDED.updated_at
+"""
+MERGE_SNAPSHOTS_SQL = f"""
+    INSERT INTO video_snapshots ({', '.join(SNAPSHOT_COLUMNS)})
+    SELECT DISTINCT ON (id)
+           id, video_id::uuid, views_count, likes_count,
+           comments_count, reports_count,
+           delta_views_count, delta_likes_count,
+           delta_comments_count, delta_reports_count,
+           created_at::timestamptz, updated_at::timestamptz
+    FROM {{snapshots_stage}}
+    ORDER BY id, updated_at::timestamptz DESC
+    ON CONFLICT (id) DO UPDATE SET
+        views_count = EXCLUDED.views_count,
+        delta_views_count = EXCLUDED.delta_views_count,
+        updated_at = EXCLUDED.updated_at
+"""
+
 
 class DataLoader:
     def __init__(self, db_url: str):
         self.db_url = db_url
         self.batch_size = 100
+        # Число параллельных обработчиков и соединений в пуле
+        self.workers = 8
+        self.total_videos = 0
+        self.total_snapshots = 0
+        self.total_batches = 0
+        # Имена промежуточных таблиц текущей загрузки
+        self.stage_tables = {}
+
+    def _iter_batches(self, f):
+        """Читает видео из файла и группирует их в пакеты по batch_size."""
+        if ijson is not None:
+            videos = ijson.items(f, 'videos.item', buf_size=READ_BUFFER_SIZE)
+        else:
+            # Без ijson файл разбирается целиком
+            videos = _loads(f.read()).get('videos', [])
+
+        batch = []
+        for video in videos:
+            batch.append(video)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _read_batches(self, filepath: str, queue: asyncio.Queue, loop,
+                      stop: threading.Event):
+        """
+        Разбирает файл и передает пакеты в очередь цикла событий.
+
+        Поток завершается, как только выставлен stop: иначе при ошибке
+        записи он навсегда повис бы на полной очереди, которую никто
+        не разбирает, а вместе с ним и завершение asyncio.run.
+        """
+        with open(filepath, 'rb', buffering=READ_BUFFER_SIZE) as f:
+            for batch in self._iter_batches(f):
+                # Ждем места в очереди, чтобы разбор не убегал далеко вперед
+                future = asyncio.run_coroutine_threadsafe(
+                    queue.put(batch), loop
+                )
+                while True:
+                    if stop.is_set():
+                        future.cancel()
+                        return
+                    try:
+                        future.result(timeout=STOP_POLL_INTERVAL)
+                        break
+                    except concurrent.futures.TimeoutError:
+                        continue
 
-    def _parse_datetime(self, dt_str: str) -> Optional[datetime]:
-        """Преобразует строку в формате ISO 8601 в объект datetime в UTC."""
-        if not dt_str:
-            return None
+    async def _produce_batches(self, filepath: str, queue: asyncio.Queue,
+                               stop: threading.Event):
+        """
+        Разбирает файл в отдельном потоке и кладет пакеты в очередь.
 
+        Весь файл читается и разбирается одним потоком, пока цикл событий
+        записывает уже готовые пакеты в БД. В конце (в том числе при ошибке
+        разбора) в очередь кладется None.
+        """
+        loop = asyncio.get_running_loop()
         try:
-            # Если строка заканчивается на 'Z', заменяем на '+00:00'
-            if dt_str.endswith('Z'):
-                dt_str = dt_str[:-1] + '+00:00'
+            await asyncio.to_thread(
+                self._read_batches, filepath, queue, loop, stop
+            )
+        finally:
+            await queue.put(None)
 
-            # Преобразуем строку в datetime с учетом часового пояса
-            dt = datetime.fromisoformat(dt_str)
+    async def _consume_batches(self, pool, queue: asyncio.Queue):
+        """
+        Берет пакеты из очереди и записывает их через соединение пула.
 
-            # Приводим к UTC
-            if dt.tzinfo is not None:
-                dt = dt.astimezone(timezone.utc)
-            else:
-                # Если часового пояса нет, считаем что это UTC
-                dt = dt.replace(tzinfo=timezone.utc)
+        Обработчик держит одно соединение и буферы строк до конца загрузки.
+        """
+        # Буфер снапшотов дорастает до самого большого пакета и дальше
+        # переиспользуется без перевыделения памяти
+        video_buf = [None] * self.batch_size
+        snapshot_buf = [None] * (self.batch_size * SNAPSHOTS_PER_VIDEO)
+        async with pool.acquire() as conn:
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    # Возвращаем признак конца для остальных обработчиков
+                    queue.put_nowait(None)
+                    return
 
-            return dt
-        except Exception as e:
-            logger.error(f"Ошибка парсинга даты '{dt_str}': {e}")
-            return None
+                video_count, snapshot_count = await self._process_batch(
+                    conn, batch, video_buf, snapshot_buf
+                )
 
-    async def load_json_file(self, filepath: str) -> None:
-        logger.info(f"Начинаю загрузку данных из файла: {filepath}")
+                self.total_videos += video_count
+                self.total_snapshots += snapshot_count
+                self.total_batches += 1
+                if self.total_batches % LOG_EVERY_BATCHES == 0:
+                    logger.info("Обработано %d видео", self.total_videos)
 
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+    async def load_json_file(self, filepath: str) -> None:
+        logger.info("Начинаю загрузку данных из файла: %s", filepath)
 
-        videos = data.get('videos', [])
-        logger.info(f"Найдено {len(videos)} видео для обработки.")
+        # Строки дат без часового пояса считаются UTC
+        pool = await asyncpg.create_pool(
+            self.db_url,
+            min_size=self.workers,
+            max_size=self.workers,
+            statement_cache_size=1024,
+            server_settings={'timezone': 'UTC'}
+        )
+        suffix = uuid.uuid4().hex
+        self.stage_tables = {
+            'videos_stage': STAGE_VIDEOS_PREFIX + suffix,
+            'snapshots_stage': STAGE_SNAPSHOTS_PREFIX + suffix,
+        }
+        queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        # Сигнал потоку разбора прекратить работу при ошибке записи
+        stop = threading.Event()
+        self.total_videos = 0
+        self.total_snapshots = 0
+        self.total_batches = 0
 
-        conn = await asyncpg.connect(self.db_url)
+        tasks = []
 
         try:
-            total_snapshots = 0
-            for i in range(0, len(videos), self.batch_size):
-                batch = videos[i:i + self.batch_size]
-                await self._process_batch(conn, batch)
-                total_snapshots += sum(
-                    len(v.get('snapshots', [])) for v in batch
-                )
-                logger.info(
-                    f"Обработано {min(i + self.batch_size, len(videos))}/"
-                    f"{len(videos)} видео"
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    CREATE_STAGE_SQL.format(**self.stage_tables)
                 )
 
+            # Пакеты копируются в промежуточные таблицы параллельно
+            # несколькими обработчиками; порядок не важен, так как перенос
+            # идет через ON CONFLICT
+            tasks.append(asyncio.create_task(
+                self._produce_batches(filepath, queue, stop)
+            ))
+            tasks += [
+                asyncio.create_task(self._consume_batches(pool, queue))
+                for _ in range(self.workers)
+            ]
+            await asyncio.gather(*tasks)
+            await self._merge_stage(pool)
+
             logger.info(
-                f"Загрузка завершена. Успешно загружено: "
-                f"{len(videos)} видео, {total_snapshots} снапшотов"
+                "Загрузка завершена. Успешно загружено: "
+                "%d видео, %d снапшотов",
+                self.total_videos, self.total_snapshots
             )
 
         except Exception as e:
-            logger.error(f"Ошибка при загрузке данных: {e}")
+            logger.error("Ошибка при загрузке данных: %s", e)
             raise
         finally:
-            await conn.close()
-
-    async def _process_batch(self, conn, batch: List[Dict]):
-        async with conn.transaction():
-            for video in batch:
-                # Преобразуем строки дат в объекты datetime для видео
-                video['video_created_at'] = self._parse_datetime(
-                    video['video_created_at']
-                )
-                video['created_at'] = self._parse_datetime(video['created_at'])
-                video['updated_at'] = self._parse_datetime(video['updated_at'])
-
-                await self._insert_video(conn, video)
+            stop.set()
+            for task in tasks:
+                task.cancel()
+            await self._drop_stage(pool)
+            await pool.close()
 
-                # Обрабатываем снапшоты этого видео
-                for snapshot in video.get('snapshots', []):
-                    snapshot['created_at'] = self._parse_datetime(
-                        snapshot['created_at']
-                    )
-                    snapshot['updated_at'] = self._parse_datetime(
-                        snapshot['updated_at']
-                    )
+    async def _drop_stage(self, pool) -> None:
+        """
+        Удаляет промежуточные таблицы загрузки.
 
-                    await self._insert_snapshot(conn, snapshot)
-
-    async def _insert_video(self, conn, video: Dict):
+        Ошибка удаления только пишется в лог, чтобы не скрыть исходную
+        ошибку загрузки.
+        """
         try:
-            await conn.execute(
-                """
-                INSERT INTO videos (
-                    id, creator_id, video_created_at, views_count,
-                    likes_count, comments_count, reports_count,
-                    created_at, updated_at
-                ) VALUES (
-                    $1, $2, $3, $4, $5, $6, $7, $8, $9
-                )
-                ON CONFLICT (id) DO UPDATE SET
-                    views_count = EXCLUDED.views_count,
-                    updated_at = EXCLUDED.updated_at
-                """,
-                video['id'],
-                video['creator_id'],
-                video['video_created_at'],
-                video['views_count'],
-                video['likes_count'],
-                video['comments_count'],
-                video['reports_count'],
-                video['created_at'],
-                video['updated_at']
-            )
+            async with pool.acquire() as conn:
+                await conn.execute(DROP_STAGE_SQL.format(**self.stage_tables))
         except Exception as e:
-            logger.error(f"Ошибка при вставке видео {video['id']}: {e}")
-            raise
+            logger.warning(
+                "Не удалось удалить промежуточные таблицы %s, %s: %s",
+                self.stage_tables['videos_stage'],
+                self.stage_tables['snapshots_stage'], e
+            )
 
-    async def _insert_snapshot(self, conn, snapshot: Dict):
-        try:
-            await conn.execute(
-                """
-                INSERT INTO video_snapshots (
-                    id, video_id, views_count, likes_count,
-                    comments_count, reports_count,
-                    delta_views_count, delta_likes_count,
-                    delta_comments_count, delta_reports_count,
-                    created_at, updated_at
-                ) VALUES (
-                    $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12
+    async def _merge_stage(self, pool) -> None:
+        """
+        Переносит данные из промежуточных таблиц одной транзакцией.
+
+        Весь файл фиксируется одним COMMIT, а synchronous_commit = off
+        избавляет и его от ожидания сброса WAL на диск.
+        """
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("SET LOCAL synchronous_commit = off")
+                await conn.execute(
+                    MERGE_VIDEOS_SQL.format(**self.stage_tables)
+                )
+                await conn.execute(
+                    MERGE_SNAPSHOTS_SQL.format(**self.stage_tables)
                 )
-                ON CONFLICT (id) DO UPDATE SET
-                    views_count = EXCLUDED.views_count,
-                    delta_views_count = EXCLUDED.delta_views_count,
-                    updated_at = EXCLUDED.updated_at
-                """,
-                snapshot['id'],
-                snapshot['video_id'],
-                snapshot['views_count'],
-                snapshot['likes_count'],
-                snapshot['comments_count'],
-                snapshot['reports_count'],
-                snapshot['delta_views_count'],
-                snapshot['delta_likes_count'],
-                snapshot['delta_comments_count'],
-                snapshot['delta_reports_count'],
-                snapshot['created_at'],
-                snapshot['updated_at']
+
+    async def _process_batch(self, conn, batch: List[Dict],
+                             video_buf: List, snapshot_buf: List):
+        """
+        Копирует пакет в промежуточные таблицы и возвращает число видео
+        и снапшотов в нем.
+
+        Строки пишутся по индексу в буферы обработчика: списки не растут
+        заново на каждом пакете, а в COPY уходит только заполненная часть.
+        """
+        video_count = 0
+        snapshot_count = 0
+        # Строки видео и снапшотов собираются за один проход по пакету
+        for video in batch:
+            video_buf[video_count] = _video_row(video)
+            video_count += 1
+            # Кортеж по умолчанию не создает новый пустой список
+            for snapshot in video.get('snapshots', ()):
+                if snapshot_count < len(snapshot_buf):
+                    snapshot_buf[snapshot_count] = _snapshot_row(snapshot)
+                else:
+                    snapshot_buf.append(_snapshot_row(snapshot))
+                snapshot_count += 1
+
+        # COPY без отдельной транзакции: каждая команда и так атомарна,
+        # а данные становятся видны основным таблицам только при переносе
+        if video_count:
+            await conn.copy_records_to_table(
+                self.stage_tables['videos_stage'],
+                records=islice(video_buf, video_count),
+                columns=VIDEO_COLUMNS
             )
-        except Exception as e:
-            logger.error(f"Ошибка при вставке снапшота {snapshot['id']}: {e}")
-            raise
+        if snapshot_count:
+            await conn.copy_records_to_table(
+                self.stage_tables['snapshots_stage'],
+                records=islice(snapshot_buf, snapshot_count),
+                columns=SNAPSHOT_COLUMNS
+            )
+
+        return video_count, snapshot_count
 
 
 async def main():
     from app.config import DATABASE_URL
 
-    # Настройки подключения
-    DB_URL = DATABASE_URL
+    # Строка подключения берется из той же конфигурации, что и у бота
     JSON_FILE_PATH = "videos.json"
 
-    loader = DataLoader(DB_URL)
+    loader = DataLoader(DATABASE_URL)
     await loader.load_json_file(JSON_FILE_PATH)
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())